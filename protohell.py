@@ -1,17 +1,18 @@
 import base64
+import copyreg
 import dataclasses
 import datetime
-import enum
 import hashlib
-import io
-import json
+import os
 import plistlib
+import struct
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional
 
-import asn1
 import betterproto
+import orjson
 import requests
 import rich
 from google.protobuf import struct_pb2
@@ -29,7 +30,6 @@ from lib import (
     LogHeadResponse,
     LogLeavesRequest,
     LogLeavesResponse,
-    LogLeavesResponseLeaf,
     LogType,
     NodeType,
     ProtocolVersion,
@@ -37,7 +37,9 @@ from lib import (
 )
 
 SAVE_DIR = Path("releases")
-SAVE_DIR.mkdir(exist_ok=True)
+
+# Check each release leaf's raw data against its SHA-256 hash; only turn off for data you already trust
+VERIFY_HASHES = True
 
 REQUEST_UUID = str(uuid.uuid4())
 
@@ -47,14 +49,22 @@ SESSION.headers = {"X-Apple-Request-UUID": REQUEST_UUID, "Content-Type": "applic
 
 
 BAG_URL = "https://init-kt-prod.ess.apple.com/init/getBag?ix=5&p=atresearch"
-BAG = plistlib.loads(SESSION.get(BAG_URL, timeout=3).content)
+_BAG: Optional[dict] = None
+
+
+# Fetched on first use so importing this module (including in pool workers) doesn't hit the network
+def _bag() -> dict:
+    global _BAG  # pylint: disable=global-statement
+    if _BAG is None:
+        _BAG = plistlib.loads(SESSION.get(BAG_URL, timeout=3).content)
+    return _BAG
 
 
 def get_trees():
     body = ListTreesRequest(ProtocolVersion.V3, REQUEST_UUID)
 
     resp = SESSION.post(
-        BAG["at-researcher-list-trees"],
+        _bag()["at-researcher-list-trees"],
         data=bytes(body),
         timeout=5,
     )
@@ -68,7 +78,7 @@ def get_trees():
 def get_log_head_for_tree(tree: ListTreesResponseTree):
     body = LogHeadRequest(ProtocolVersion.V3, tree.tree_id, -1, REQUEST_UUID)
     resp = SESSION.post(
-        BAG["at-researcher-log-head"],
+        _bag()["at-researcher-log-head"],
         data=bytes(body),
         timeout=5,
     )
@@ -84,7 +94,7 @@ def get_log_head_for_tree(tree: ListTreesResponseTree):
 def get_log_leaves(tree: ListTreesResponseTree, start_index: int, end_index: int):
     body = LogLeavesRequest(ProtocolVersion.V3, tree.tree_id, start_index, end_index, REQUEST_UUID, 0, tree.merge_groups)
     resp = SESSION.post(
-        BAG["at-researcher-log-leaves"],
+        _bag()["at-researcher-log-leaves"],
         data=bytes(body),
         timeout=5,
     )
@@ -95,16 +105,15 @@ def get_log_leaves(tree: ListTreesResponseTree, start_index: int, end_index: int
     return log_leaves
 
 
-@dataclasses.dataclass
-class TransparencyExtension:
+class TransparencyExtension(NamedTuple):
     type: int
     data: bytes
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class ATLeaf:
     version: int
-    type: AtLogDataType
+    type: int  # AtLogDataType value
     description: Optional[str]
     hash: Optional[bytes]
     expiry_ms: int
@@ -115,32 +124,107 @@ class ATLeaf:
         return datetime.datetime.fromtimestamp(self.expiry_ms / 1000, datetime.timezone.utc)
 
 
+RELEASE_TYPE = AtLogDataType.RELEASE.value
+EXPIRY_AND_EXTENSIONS_SIZE = struct.Struct(">QH")
+EXTENSION_HEADER = struct.Struct(">BH")
+
+
 def parse_at_leaf(raw: bytes):
-    with io.BytesIO(raw) as stream:
-        version = stream.read(1)[0]
-        type = AtLogDataType(stream.read(1)[0])  # pylint: disable=missing-kwoa,too-many-function-args
-        description_size = stream.read(1)[0]
-        description = stream.read(description_size).decode() or None
-        hash_size = stream.read(1)[0]
-        hash = stream.read(hash_size) or None
-        expiry_ms = int.from_bytes(stream.read(8), "big")
-        extensions_size = int.from_bytes(stream.read(2), "big")
-        extensions_raw = stream.read(extensions_size)
-
-        extensions = []
-
-        with io.BytesIO(extensions_raw) as extensions_stream:
-            while extensions_stream.tell() < extensions_size:
-                extension_type = extensions_stream.read(1)[0]
-                extension_size = int.from_bytes(extensions_stream.read(2), "big")
-                extension_data = extensions_stream.read(extension_size)
-                extension = TransparencyExtension(extension_type, extension_data)
-                extensions.append(extension)
+    mv = memoryview(raw)
+    o = 0
+
+    version = mv[o]
+    o += 1
+    type = mv[o]
+    o += 1
+    description_size = mv[o]
+    o += 1
+    description = bytes(mv[o : o + description_size]).decode() or None
+    o += description_size
+    hash_size = mv[o]
+    o += 1
+    hash = bytes(mv[o : o + hash_size]) or None
+    o += hash_size
+    # Bounds-checked so a truncated leaf raises IndexError like the Cython parser, not struct.error
+    if o + EXPIRY_AND_EXTENSIONS_SIZE.size > len(mv):
+        raise IndexError("AT leaf truncated")
+    expiry_ms, extensions_size = EXPIRY_AND_EXTENSIONS_SIZE.unpack_from(mv, o)
+    o += EXPIRY_AND_EXTENSIONS_SIZE.size
+    extensions_end = o + extensions_size
+
+    extensions = []
+    append_extension = extensions.append
+
+    while o < extensions_end:
+        if o + EXTENSION_HEADER.size > len(mv):
+            raise IndexError("AT leaf truncated")
+        extension_type, extension_size = EXTENSION_HEADER.unpack_from(mv, o)
+        o += EXTENSION_HEADER.size
+        extension_data = bytes(mv[o : min(o + extension_size, extensions_end)])
+        o += extension_size
+        append_extension(TransparencyExtension(extension_type, extension_data))
 
     return ATLeaf(version, type, description, hash, expiry_ms, extensions)
 
 
-@dataclasses.dataclass(init=False)
+# Use the Cython parser if it has been built (see README), otherwise keep the pure Python one above
+try:
+    from protohell_parse import parse_at_leaf as _parse_at_leaf_native
+except ImportError:
+    pass
+else:
+
+    def parse_at_leaf(raw: bytes):  # noqa: F811 # pylint: disable=function-redefined
+        version, type, description, hash, expiry_ms, extensions = _parse_at_leaf_native(raw)
+        return ATLeaf(version, type, description, hash, expiry_ms, list(map(TransparencyExtension._make, extensions)))
+
+
+DER_INTEGER = 0x02
+DER_OCTET_STRING = 0x04
+DER_SEQUENCE = 0x30
+DER_SET = 0x31
+
+
+def _read_der_header(mv: memoryview, o: int, expected_tag: int) -> tuple[int, int]:
+    # Returns the start and end offsets of the value
+    assert mv[o] == expected_tag, f"Expected tag {expected_tag:#x}, got {mv[o]:#x}"
+    length = mv[o + 1]
+    o += 2
+    if length & 0x80:
+        length_size = length & 0x7F
+        assert length_size, "Indefinite length is not valid DER"
+        length = int.from_bytes(mv[o : o + length_size], "big")
+        o += length_size
+    assert o + length <= len(mv), "DER value truncated"
+    return o, o + length
+
+
+def _parse_tickets(raw: bytes) -> tuple[tuple[int, int], list[tuple[int, int]]]:
+    # SEQUENCE { INTEGER version, OCTET STRING ap_ticket, SET OF OCTET STRING cryptex_tickets }
+    # Returns the (start, end) offsets of each ticket in raw
+    mv = memoryview(raw)
+    o, _ = _read_der_header(mv, 0, DER_SEQUENCE)
+
+    o, end = _read_der_header(mv, o, DER_INTEGER)
+    assert int.from_bytes(mv[o:end], "big", signed=True) == 1
+    o = end
+
+    o, end = _read_der_header(mv, o, DER_OCTET_STRING)
+    ap_ticket_range = (o, end)
+    o = end
+
+    o, set_end = _read_der_header(mv, o, DER_SET)
+    cryptex_ticket_ranges = []
+    append_cryptex_ticket_range = cryptex_ticket_ranges.append
+    while o < set_end:
+        o, end = _read_der_header(mv, o, DER_OCTET_STRING)
+        append_cryptex_ticket_range((o, end))
+        o = end
+
+    return ap_ticket_range, cryptex_ticket_ranges
+
+
+@dataclasses.dataclass(init=False, slots=True)
 class Release:
     index: int
     created: datetime.datetime
@@ -151,41 +235,89 @@ class Release:
     ap_ticket: bytes
     cryptex_tickets: list[bytes]
     darwin_init: dict
+    ap_ticket_digest: str = dataclasses.field(repr=False)
+    cryptex_ticket_digests: list[str] = dataclasses.field(repr=False)
+    ticket_ranges: tuple[tuple[int, int], list[tuple[int, int]]] = dataclasses.field(repr=False)
 
-    def __init__(self, log_leaf: LogLeavesResponseLeaf, at_leaf: ATLeaf) -> None:
-        self.index = log_leaf.index
+    def __init__(self, index: int, metadata: bytes, raw_data: bytes, at_leaf: ATLeaf) -> None:
+        self.index = index
         self.expires = at_leaf.expiry
         self.hash = at_leaf.hash
-        release_metadata = ReleaseMetadata().parse(log_leaf.metadata)
+        release_metadata = ReleaseMetadata().parse(metadata)
         self.created = release_metadata.timestamp
         self.assets = [x.to_pydict() for x in release_metadata.assets]
-        self.darwin_init = MessageToDict(struct_pb2.Struct.FromString(bytes(release_metadata.darwin_init)))
+        # bytes() re-serializes betterproto's Struct for google.protobuf; an empty one would just become {}
+        darwin_init = release_metadata.darwin_init
+        self.darwin_init = MessageToDict(struct_pb2.Struct.FromString(bytes(darwin_init))) if darwin_init else {}
+
+        self.ticket_ranges = _parse_tickets(raw_data)
+        (ap_start, ap_end), cryptex_ticket_ranges = self.ticket_ranges
+
+        # Hashed here so it happens in the worker processes rather than the dump loop
+        mv = memoryview(raw_data)
+        self.ap_ticket_digest = hashlib.sha256(mv[ap_start:ap_end]).hexdigest()
+        self.cryptex_ticket_digests = [hashlib.sha256(mv[start:end]).hexdigest() for start, end in cryptex_ticket_ranges]
+
+    def attach_tickets(self, raw_data: bytes) -> None:
+        (ap_start, ap_end), cryptex_ticket_ranges = self.ticket_ranges
+        self.tickets_raw = raw_data
+        self.ap_ticket = raw_data[ap_start:ap_end]
+        self.cryptex_tickets = [raw_data[start:end] for start, end in cryptex_ticket_ranges]
+
+
+# betterproto's Enum.__new__ is keyword-only and there's no __reduce__, so its members pickle but can't be unpickled.
+# Release.assets holds them and gets pickled back from the process pool; try_value also keeps unknown values.
+def _reduce_enum(member: betterproto.Enum):
+    return type(member).try_value, (int(member),)
+
 
-        self.tickets_raw = log_leaf.raw_data
+for _enum in betterproto.Enum.__subclasses__():
+    copyreg.pickle(_enum, _reduce_enum)
 
-        decoder = asn1.Decoder()
-        decoder.start(log_leaf.raw_data)
-        tag = decoder.peek()
-        assert tag.nr == asn1.Numbers.Sequence
-        decoder.enter()
 
-        tag, version = decoder.read()
-        assert tag.nr == asn1.Numbers.Integer
-        assert version == 1
+# Runs in a worker process, so only plain bytes/ints are passed in.
+# The returned Release has no ticket bytes yet, so the raw data only crosses the pool once.
+def _process_leaf(node_bytes: bytes, raw_data: bytes, metadata: bytes, index: int) -> Optional[Release]:
+    change_log_node = ChangeLogNodeV2().parse(node_bytes)
+    mutation = change_log_node.mutation
 
-        tag, ap_ticket = decoder.read()
-        assert tag.nr == asn1.Numbers.OctetString
-        self.ap_ticket: bytes = ap_ticket
+    # Byte 1 of the AT leaf is its type; only releases are kept, so don't parse or hash anything else
+    if mutation[1] != RELEASE_TYPE:
+        return None
 
-        tag = decoder.peek()
-        assert tag.nr == asn1.Numbers.Set
-        self.cryptex_tickets = []
-        decoder.enter()
+    at_leaf = parse_at_leaf(mutation)
 
-        while not decoder.eof():
-            tag, cryptex_ticket = decoder.read()
-            assert tag.nr == asn1.Numbers.OctetString
-            self.cryptex_tickets.append(cryptex_ticket)
+    if raw_data and VERIFY_HASHES:
+        assert hashlib.sha256(raw_data).digest() == at_leaf.hash, "Hash mismatch"
+
+    return Release(index, metadata, raw_data, at_leaf)
+
+
+def get_releases_from_leaves(log_leaves: LogLeavesResponse):
+    atl_leaves = [x for x in log_leaves.leaves if x.node_type == NodeType.ATL_NODE]
+
+    args = (
+        [x.node_bytes for x in atl_leaves],
+        [x.raw_data for x in atl_leaves],
+        [x.metadata for x in atl_leaves],
+        [x.index for x in atl_leaves],
+    )
+
+    # A pool only adds pickling overhead on a single core.
+    # Both map()s keep input order, so releases stay sorted by index
+    if (os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(_process_leaf, *args, chunksize=64))
+    else:
+        results = list(map(_process_leaf, *args))
+
+    releases: list[Release] = []
+    for log_leaf, release in zip(atl_leaves, results):
+        if release is not None:
+            release.attach_tickets(log_leaf.raw_data)
+            releases.append(release)
+
+    return releases
 
 
 def get_releases():
@@ -207,37 +339,63 @@ def get_releases():
     print(f"Log size: {end_index}")
     log_leaves = get_log_leaves(selected_tree, start_index, end_index)
 
-    releases: list[Release] = []
-
-    for log_leaf in log_leaves.leaves:
-        if log_leaf.node_type == NodeType.ATL_NODE:
-            raw_data = log_leaf.raw_data
-            change_log_node = ChangeLogNodeV2().parse(log_leaf.node_bytes)
-            at_leaf = parse_at_leaf(change_log_node.mutation)
-
-            if raw_data:
-                assert hashlib.sha256(raw_data).digest() == at_leaf.hash, "Hash mismatch"
-
-            if at_leaf.type == AtLogDataType.RELEASE:
-                release = Release(log_leaf, at_leaf)
-                releases.append(release)
-
-    return releases
+    return get_releases_from_leaves(log_leaves)
 
 
+# orjson handles datetimes and (betterproto) enums natively, so only bytes need help
 def serializer(obj):
-    if isinstance(obj, (datetime.datetime, datetime.date)):
-        return obj.isoformat()
-    elif isinstance(obj, bytes):
+    if isinstance(obj, bytes):
         # return base64.b64encode(obj).decode()
         return obj.hex()
-    elif isinstance(obj, (enum.Enum, betterproto.Enum)):
-        assert False
-        return obj.name
-    # elif isinstance(obj, asn1.Object):
-    #     return obj.dump()
-    else:
-        return obj
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def to_json(obj) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2, default=serializer)
+
+
+def _write_raw(path: Path, content: bytes):
+    # Unbuffered write, skipping the io layer that Path.write_bytes goes through
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+def save_release(release: Release):
+    release_dir = SAVE_DIR / f"{release.index}"
+    release_dir.mkdir(exist_ok=True)
+    with (release_dir / "description.txt").open("w") as f:
+        rich.print(release, file=f)
+    _write_raw(
+        release_dir / "metadata.json",
+        to_json(
+            {
+                "index": release.index,
+                "created": release.created,
+                "expires": release.expires,
+                "hash": release.hash,
+                "tickets": {
+                    "os": release.ap_ticket_digest,
+                    "cryptexes": release.cryptex_ticket_digests,
+                },
+            }
+        ),
+    )
+    if release.assets:
+        _write_raw(release_dir / "assets.json", to_json(release.assets))
+    if release.darwin_init:
+        _write_raw(release_dir / "darwin_init.json", to_json(release.darwin_init))
+    _write_raw(release_dir / "tickets_raw.der", release.tickets_raw)
+    _write_raw(release_dir / "apticket.der", release.ap_ticket)
+
+    cryptex_tickets_dir = release_dir / "cryptex_tickets"
+    cryptex_tickets_dir.mkdir(exist_ok=True)
+    for i, ticket in enumerate(release.cryptex_tickets):
+        _write_raw(cryptex_tickets_dir / f"cryptex_ticket_{i}.der", ticket)
 
 
 if __name__ == "__main__":
@@ -245,31 +403,9 @@ if __name__ == "__main__":
 
     for release in releases:
         rich.print(release)
-        release_dir = SAVE_DIR / f"{release.index}"
-        release_dir.mkdir(exist_ok=True)
-        with (release_dir / "description.txt").open("w") as f:
-            rich.print(release, file=f)
-        (release_dir / "metadata.json").write_text(
-            json.dumps(
-                {i: v for i, v in dataclasses.asdict(release).items() if i in ["index", "created", "expires", "hash"]}
-                | {
-                    "tickets": {
-                        "os": hashlib.sha256(release.ap_ticket).hexdigest(),
-                        "cryptexes": [hashlib.sha256(x).hexdigest() for x in release.cryptex_tickets],
-                    }
-                },
-                indent=4,
-                default=serializer,
-            )
-        )
-        if release.assets:
-            (release_dir / "assets.json").write_text(json.dumps(release.assets, indent=4, default=serializer))
-        if release.darwin_init:
-            (release_dir / "darwin_init.json").write_text(json.dumps(release.darwin_init, indent=4, default=serializer))
-        (release_dir / "tickets_raw.der").write_bytes(release.tickets_raw)
-        (release_dir / "apticket.der").write_bytes(release.ap_ticket)
-
-        cryptex_tickets_dir = release_dir / "cryptex_tickets"
-        cryptex_tickets_dir.mkdir(exist_ok=True)
-        for i, ticket in enumerate(release.cryptex_tickets):
-            (cryptex_tickets_dir / f"cryptex_ticket_{i}.der").write_bytes(ticket)
+
+    SAVE_DIR.mkdir(exist_ok=True)
+
+    # Disk writes are I/O bound, so overlap them; consuming the results re-raises any errors
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(save_release, releases))
@@ -0,0 +1,60 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Native version of protohell.parse_at_leaf. Build with `cythonize -i protohell_parse.pyx`.
+# Returns raw fields; protohell wraps them into ATLeaf/TransparencyExtension.
+
+from libc.stdint cimport uint64_t
+
+
+cdef inline void _need(Py_ssize_t o, Py_ssize_t n, Py_ssize_t size) except *:
+    if o + n > size:
+        raise IndexError("AT leaf truncated")
+
+
+cpdef tuple parse_at_leaf(bytes raw):
+    cdef const unsigned char* buf = raw
+    cdef Py_ssize_t size = len(raw)
+    cdef Py_ssize_t o = 0
+    cdef Py_ssize_t description_size, hash_size, extensions_end, extension_size, data_end
+    cdef unsigned int version, type, extension_type
+    cdef uint64_t expiry_ms
+
+    _need(o, 3, size)
+    version = buf[o]
+    type = buf[o + 1]
+    description_size = buf[o + 2]
+    o += 3
+    description = raw[o : o + description_size].decode() or None
+    o += description_size
+
+    _need(o, 1, size)
+    hash_size = buf[o]
+    o += 1
+    hash = raw[o : o + hash_size] or None
+    o += hash_size
+
+    _need(o, 10, size)
+    expiry_ms = (
+        (<uint64_t>buf[o] << 56)
+        | (<uint64_t>buf[o + 1] << 48)
+        | (<uint64_t>buf[o + 2] << 40)
+        | (<uint64_t>buf[o + 3] << 32)
+        | (<uint64_t>buf[o + 4] << 24)
+        | (<uint64_t>buf[o + 5] << 16)
+        | (<uint64_t>buf[o + 6] << 8)
+        | <uint64_t>buf[o + 7]
+    )
+    extensions_end = o + 10 + ((buf[o + 8] << 8) | buf[o + 9])
+    o += 10
+
+    extensions = []
+
+    while o < extensions_end:
+        _need(o, 3, size)
+        extension_type = buf[o]
+        extension_size = (buf[o + 1] << 8) | buf[o + 2]
+        o += 3
+        data_end = min(o + extension_size, extensions_end)
+        extensions.append((extension_type, raw[o:data_end]))
+        o += extension_size
+
+    return version, type, description, hash, expiry_ms, extensions